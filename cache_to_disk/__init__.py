@@ -30,14 +30,22 @@ Modifications:
         - Expansion of shell variables and tilde-user values for directories/files
 """
 # Standard Library
+import atexit
+import hashlib
 import json
 import logging
 import os
 import pickle
+import queue
+import sys
+import threading
+import time
 import warnings
-from collections import namedtuple
-from copy import deepcopy
-from datetime import datetime
+import weakref
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
 from os import getenv
 from os.path import (
     dirname,
@@ -47,6 +55,28 @@ from os.path import (
     join as join_path,
     realpath)
 
+# Optional
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Not available on Windows, where the metadata lock only covers threads
+    fcntl = None
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+if orjson is not None:
+    _json_dumps, _json_loads = orjson.dumps, orjson.loads
+else:  # pragma: no cover
+    def _json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+    _json_loads = json.loads
 
 logger = logging.getLogger(__name__)
 
@@ -55,16 +85,66 @@ if logger.handlers is None:
     logger.addHandler(logging.NullHandler())
 
 MAX_PICKLE_BYTES = 2 ** 31 - 1
+# Pickle files are streamed through buffers this large, so the pickler's many small
+# frame writes and the unpickler's small reads turn into few large syscalls
+PICKLE_BUFFER_SIZE = 2 ** 20
+# Pickles are zstd-compressed when the optional zstandard package is installed
+PICKLE_EXTENSION = '.pkl' if zstandard is None else '.pkl.zst'
+ZSTD_LEVEL = 3
 DISK_CACHE_DIR = expanduser(expandvars(
     getenv('DISK_CACHE_DIR', join_path(dirname(realpath(__file__)), 'disk_cache'))))
 DISK_CACHE_FILE = expanduser(expandvars(join_path(
     DISK_CACHE_DIR, getenv('DISK_CACHE_FILENAME', 'cache_to_disk_caches.json'))))
+# Metadata changes are appended here and folded into DISK_CACHE_FILE by _compact()
+DISK_CACHE_JOURNAL = DISK_CACHE_FILE + '.journal'
+DISK_CACHE_LOCK = DISK_CACHE_FILE + '.lock'
+MAX_JOURNAL_BYTES = 2 ** 22
 
 # Specify 0 for cache age days to keep forever; not recommended for obvious reasons
 UNLIMITED_CACHE_AGE = 0
 DEFAULT_CACHE_AGE = 7
+# Most recent results kept in memory per decorated function. Off by default: cached results
+# are often too large to hold many of in memory, and hits would share one mutable object
+DEFAULT_MEMORY_CACHE_SIZE = 0
+_SECONDS_PER_DAY = 24 * 60 * 60
 
+# No longer updated now that file names are hashes; kept in the metadata file for older versions
 _TOTAL_NUMCACHE_KEY = 'total_number_of_cache_to_disks'
+# Mixed into every argument key: pickles written by one Python version (e.g. with a newer
+# HIGHEST_PROTOCOL) aren't guaranteed to load in another, so each version keeps its own entries
+_KEY_PREFIX = ('py%d.%d|' % sys.version_info[:2]).encode()
+# Epoch time of the last delete_old_disk_caches() sweep by any process
+_LAST_SWEEP_KEY = '_last_sweep'
+_RESERVED_KEYS = (_TOTAL_NUMCACHE_KEY, _LAST_SWEEP_KEY)
+SWEEP_INTERVAL_SECONDS = 60 * 60
+# Threads used to unlink files when clearing a function's cache
+MAX_REMOVE_WORKERS = 8
+# Set $DISK_CACHE_BACKGROUND_WRITES=1 to pickle and write new cache entries on a background
+# thread, so callers get their result without waiting on disk I/O. Off by default: the entry
+# is pickled after the caller has it, so mutating a returned value changes what gets cached
+BACKGROUND_WRITES = getenv('DISK_CACHE_BACKGROUND_WRITES', '0') == '1'
+# Writes queued beyond this block the caller, bounding memory held by pending results
+MAX_PENDING_WRITES = 64
+# Results whose cache files exceed MIN_PAYOFF_BYTES aren't kept if pickling them took longer
+# than $DISK_CACHE_MIN_PAYOFF times as long as computing them; <= 0 disables the check
+MIN_PAYOFF_BYTES = 10 * 2 ** 20
+MIN_PAYOFF = float(getenv('DISK_CACHE_MIN_PAYOFF', '0.5'))
+
+# Process-wide copy of the parsed metadata, reparsed only when the files on disk change.
+# The dict is updated in place, so every reference handed out stays current
+_META_CACHE = {'stamp': None, 'data': None}
+_META_LOCK = threading.RLock()
+_LOCK_STATE = {'depth': 0, 'file': None}
+# Set when this process appended to the journal since it last compacted it
+_JOURNAL_STATE = {'dirty': False}
+# Set once this process has triggered (or skipped) the lazy stale-cache sweep
+_SWEEP_STATE = {'checked': False}
+# Function name -> {wrapper: (in-memory result cache, its lock)}; weakly keyed, so a
+# discarded wrapper's cached results are freed along with it
+_MEMORY_CACHES = {}
+# Queue and thread of the background writer, both created on first use
+_WRITER_STATE = {'queue': None, 'thread': None}
+_WRITER_LOCK = threading.Lock()
 
 # Run-time cache data, stolen from Python functools.lru_cache implementation
 # Events resulting in nocache are cache misses that complete, but instruct cache_to_disk to
@@ -120,19 +200,236 @@ class NoCacheCondition(Exception):
 
 
 def write_cache_file(cache_metadata_dict):
-    """Dump an object as JSON to a file"""
-    with open(DISK_CACHE_FILE, 'w') as f:
-        return json.dump(cache_metadata_dict, f)
+    """Dump an object as JSON to a file, atomically replacing any previous version"""
+    tmp_file = _tmp_path(DISK_CACHE_FILE)
+    with open(tmp_file, 'wb') as f:
+        f.write(_json_dumps(cache_metadata_dict))
+    os.replace(tmp_file, DISK_CACHE_FILE)
 
 
-def load_cache_metadata_json():
-    """Load a JSON file, create it with empty cache structure if it doesn't exist"""
+def _replay_journal(cache_metadata):
+    """Apply the records in the journal, in order, to a metadata dict
+
+    Every record is idempotent, so replaying a journal that was already folded
+    into DISK_CACHE_FILE (e.g. after a crash during _compact) is harmless
+    """
     try:
-        with open(DISK_CACHE_FILE, 'r') as f:
-            return json.load(f)
+        with open(DISK_CACHE_JOURNAL, 'rb') as f:
+            lines = f.readlines()
     except FileNotFoundError:
-        write_cache_file({_TOTAL_NUMCACHE_KEY: 0})
-        return {_TOTAL_NUMCACHE_KEY: 0}
+        return cache_metadata
+    for line in lines:
+        try:
+            record = _json_loads(line)
+        except ValueError:
+            # Most likely a partial line from an interrupted append
+            logger.warning('Skipping corrupt record in %s', DISK_CACHE_JOURNAL)
+            continue
+        op, function_name = record['op'], record.get('function_name')
+        if op == 'add':
+            cache_metadata.setdefault(function_name, {})[record['key']] = record['entry']
+        elif op == 'expire':
+            function_caches = cache_metadata.get(function_name, {})
+            function_caches.pop(record['key'], None)
+            if not function_caches:
+                cache_metadata.pop(function_name, None)
+        elif op == 'clear':
+            cache_metadata.pop(function_name, None)
+        elif op == 'sweep':
+            cache_metadata[_LAST_SWEEP_KEY] = max(cache_metadata.get(_LAST_SWEEP_KEY, 0), record['time'])
+    return cache_metadata
+
+
+def _metadata_stamp():
+    """Return a value that changes whenever the metadata file or journal is modified"""
+    try:
+        base_stat = os.stat(DISK_CACHE_FILE)
+    except FileNotFoundError:
+        return None
+    # The inode changes when _compact() replaces the file, even within one mtime tick
+    base_stamp = (base_stat.st_ino, base_stat.st_mtime_ns)
+    try:
+        journal_stat = os.stat(DISK_CACHE_JOURNAL)
+    except FileNotFoundError:
+        return base_stamp, None, 0
+    return base_stamp, journal_stat.st_mtime_ns, journal_stat.st_size
+
+
+def _set_cached_metadata(cache_metadata, stamp):
+    """Replace the contents of the process-wide metadata dict, keeping its identity"""
+    if _META_CACHE['data'] is None:
+        _META_CACHE['data'] = {}
+    if cache_metadata is not _META_CACHE['data']:
+        _META_CACHE['data'].clear()
+        _META_CACHE['data'].update(cache_metadata)
+    _META_CACHE['stamp'] = stamp
+    return _META_CACHE['data']
+
+
+@contextmanager
+def _metadata_lock():
+    """Hold the metadata lock, exclusive across threads and, where fcntl exists, processes
+
+    Re-entrant within a thread; the flock is taken by the outermost holder only
+    """
+    with _META_LOCK:
+        if _LOCK_STATE['depth'] == 0 and fcntl is not None:
+            lock_file = open(DISK_CACHE_LOCK, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            _LOCK_STATE['file'] = lock_file
+        _LOCK_STATE['depth'] += 1
+        try:
+            yield
+        finally:
+            _LOCK_STATE['depth'] -= 1
+            if _LOCK_STATE['depth'] == 0 and _LOCK_STATE['file'] is not None:
+                # Closing the file releases the flock
+                _LOCK_STATE['file'].close()
+                _LOCK_STATE['file'] = None
+
+
+def _append_journal(op, payload):
+    """Append a single metadata change to the journal, compacting it if it grew too large"""
+    record = dict(payload, op=op)
+    with _metadata_lock():
+        in_sync = _META_CACHE['stamp'] is not None and _META_CACHE['stamp'] == _metadata_stamp()
+        with open(DISK_CACHE_JOURNAL, 'ab') as f:
+            f.write(_json_dumps(record) + b'\n')
+            journal_size = f.tell()
+        _JOURNAL_STATE['dirty'] = True
+        if in_sync:
+            # The caller already applied this change to the in-memory copy
+            _META_CACHE['stamp'] = _metadata_stamp()
+        if journal_size > MAX_JOURNAL_BYTES:
+            _compact()
+
+
+def _compact(cache_metadata=None):
+    """Fold the journal into DISK_CACHE_FILE atomically, then truncate the journal"""
+    with _metadata_lock():
+        if cache_metadata is None:
+            cache_metadata = _read_cache_metadata()
+        write_cache_file(cache_metadata)
+        open(DISK_CACHE_JOURNAL, 'wb').close()
+        _JOURNAL_STATE['dirty'] = False
+        _set_cached_metadata(cache_metadata, _metadata_stamp())
+
+
+def _compact_if_dirty():
+    """Compact the journal at exit, but only if this process wrote to it"""
+    if _JOURNAL_STATE['dirty']:
+        _compact()
+
+
+def _read_cache_metadata():
+    """Parse the metadata file from disk and replay the journal on top of it"""
+    try:
+        with open(DISK_CACHE_FILE, 'rb') as f:
+            cache_metadata = _json_loads(f.read())
+    except FileNotFoundError:
+        cache_metadata = {_TOTAL_NUMCACHE_KEY: 0}
+        write_cache_file(cache_metadata)
+    if _migrate_cache_metadata(cache_metadata):
+        # Persist the upgrade so it only happens once; journal records are already current
+        write_cache_file(cache_metadata)
+    return _replay_journal(cache_metadata)
+
+
+class _HashWriter:
+    """Write-only file object that feeds everything written to it into a hash"""
+
+    def __init__(self, hasher):
+        self.write = hasher.update
+
+
+def _make_key(args, kwargs):
+    """Return the key identifying a set of call arguments within a function's cache
+
+    Arguments are hashed by their pickled value, so objects without a meaningful
+    repr() (e.g. one embedding an id) still produce stable keys. The pickler runs
+    in fast mode, without a memo, so an argument passed twice pickles the same as
+    two equal copies. Recursive or unpicklable arguments fall back to hashing
+    their repr(). Equal dicts built in a different insertion order still get
+    different keys. Keys differ between Python versions
+    """
+    call_args = (args, tuple(sorted(kwargs.items())))
+    hasher = hashlib.blake2b(_KEY_PREFIX, digest_size=16)
+    try:
+        # Stream the pickle straight into the hash rather than building it in memory first
+        pickler = pickle.Pickler(_HashWriter(hasher), protocol=pickle.HIGHEST_PROTOCOL)
+        pickler.fast = True
+        pickler.dump(call_args)
+    except Exception:  # noqa, pylint: disable=broad-except
+        hasher = hashlib.blake2b(_KEY_PREFIX + repr(call_args).encode(), digest_size=16)
+    return hasher.hexdigest()
+
+
+def _cache_file_name(function_name, key):
+    """Return the cache file name for a call; identical across processes caching the same call
+
+    Files are spread over 256 subdirectories named after the first two hex digits
+    of the hash, so no single directory grows large enough to slow the filesystem
+    """
+    name_hash = hashlib.blake2b((function_name + '|' + key).encode(), digest_size=16).hexdigest()
+    return join_path(name_hash[:2], name_hash + PICKLE_EXTENSION)
+
+
+def _migrate_cache_metadata(cache_metadata):
+    """Upgrade metadata written by older versions to the current layout, in place
+
+    Per-function caches used to be lists of entries that only kept str(args) and
+    str(kwargs), so their _make_key() keys can't be recomputed and they could
+    never be hit again; their files are deleted and the entries dropped. Entries
+    without an expires_at timestamp get one derived from their file's mtime
+
+    Returns True if anything changed
+    """
+    migrated = False
+    for function_name, function_caches in list(cache_metadata.items()):
+        if function_name in _RESERVED_KEYS:
+            continue
+        if isinstance(function_caches, list):
+            for function_cache in function_caches:
+                remove_cache_file(join_path(DISK_CACHE_DIR, function_cache['file_name']))
+            del cache_metadata[function_name]
+            migrated = True
+            continue
+        for function_cache in function_caches.values():
+            if 'expires_at' in function_cache:
+                continue
+            migrated = True
+            try:
+                created = getmtime(join_path(DISK_CACHE_DIR, function_cache['file_name']))
+            except FileNotFoundError:
+                # Expire it immediately, it has nothing to load
+                created = 0
+            function_cache['expires_at'] = _expires_at(function_cache['max_age_days'], created)
+    return migrated
+
+
+def _expires_at(n_days_to_cache, created):
+    """Return the epoch time an entry created at `created` expires, 0 if it never does"""
+    if not n_days_to_cache:
+        return 0
+    return int(created + int(n_days_to_cache) * _SECONDS_PER_DAY)
+
+
+def _is_expired(function_cache, now):
+    """Return True if a cache entry's expires_at has passed"""
+    expires_at = function_cache['expires_at']
+    return bool(expires_at) and now > expires_at
+
+
+def load_cache_metadata_json():
+    """Return the cache metadata, only reparsing it from disk if it changed since the last load"""
+    with _META_LOCK:
+        stamp = _metadata_stamp()
+        if stamp is not None and stamp == _META_CACHE['stamp']:
+            return _META_CACHE['data']
+    with _metadata_lock():
+        # Other processes can't append while we hold the lock, so the stamp stays accurate
+        cache_metadata = _read_cache_metadata()
+        return _set_cached_metadata(cache_metadata, _metadata_stamp())
 
 
 def ensure_dir(directory):
@@ -142,31 +439,94 @@ def ensure_dir(directory):
         write_cache_file({_TOTAL_NUMCACHE_KEY: 0})
 
 
+def _buffer_file_paths(file_path, n_buffers):
+    """Return the paths of the n_buffers out-of-band buffer files stored alongside a pickle file"""
+    return ['%s.%d.buf' % (file_path, idx) for idx in range(n_buffers)]
+
+
+def _read_file_into_buffer(file_path):
+    """Read a whole file into a single preallocated, writable bytearray
+
+    Reads go through a memoryview in MAX_PICKLE_BYTES slices, so nothing is copied
+    twice, and the writable buffer keeps unpickled out-of-band arrays writable
+    """
+    buf = bytearray(os.path.getsize(file_path))
+    view = memoryview(buf)
+    with open(file_path, 'rb') as f:
+        for idx in range(0, len(buf), MAX_PICKLE_BYTES):
+            f.readinto(view[idx:idx + MAX_PICKLE_BYTES])
+    return buf
+
+
+def remove_cache_file(file_path, n_buffers=0):
+    """Remove a pickle file along with its n_buffers out-of-band buffer files, if they exist"""
+    for path in _buffer_file_paths(file_path, n_buffers) + [file_path]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _tmp_path(file_path):
+    """Return a temporary path next to file_path, unique to this process and thread"""
+    return '%s.%d.%d.tmp' % (file_path, os.getpid(), threading.get_ident())
+
+
 def pickle_big_data(data, file_path):
-    """Write a pickled Python object to a file in chunks"""
-    bytes_out = pickle.dumps(data, protocol=4)
-    with open(file_path, 'wb') as f_out:
-        for idx in range(0, len(bytes_out), MAX_PICKLE_BYTES):
-            f_out.write(bytes_out[idx:idx + MAX_PICKLE_BYTES])
+    """Stream a pickled Python object to a file, zstd-compressed if file_path ends with .zst
 
+    Uses the highest pickle protocol (5+), so objects supporting out-of-band
+    buffers (e.g. numpy arrays) are written zero-copy to '<file_path>.<n>.buf'
+    files instead of being copied into the pickle stream. Each file is written
+    to a temporary path and renamed into place, buffers first, so concurrent
+    readers never see a partially written cache entry
 
-def unpickle_big_data(file_path):
-    """Return a Python object from a file containing pickled data in chunks"""
+    Returns the number of buffer files written, which unpickle_big_data() needs
+    """
+    buffers = []
+    tmp_file_path = _tmp_path(file_path)
+    tmp_file_paths = [tmp_file_path]
+    try:
+        with open(tmp_file_path, 'wb', buffering=PICKLE_BUFFER_SIZE) as f:
+            if file_path.endswith('.zst'):
+                compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+                with compressor.stream_writer(f) as writer:
+                    pickle.Pickler(
+                        writer, protocol=pickle.HIGHEST_PROTOCOL, buffer_callback=buffers.append).dump(data)
+            else:
+                pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL, buffer_callback=buffers.append).dump(data)
+        for buf, buffer_file_path in zip(buffers, _buffer_file_paths(file_path, len(buffers))):
+            tmp_file_paths.append(_tmp_path(buffer_file_path))
+            with open(tmp_file_paths[-1], 'wb') as f:
+                f.write(buf.raw())
+            os.replace(tmp_file_paths[-1], buffer_file_path)
+        os.replace(tmp_file_path, file_path)
+    finally:
+        for path in tmp_file_paths:
+            if file_exists(path):
+                os.remove(path)
+    return len(buffers)
+
+
+def unpickle_big_data(file_path, n_buffers=0):
+    """Return a Python object from a file containing pickled data, with its n_buffers out-of-band buffers"""
+    buffers = [_read_file_into_buffer(p) for p in _buffer_file_paths(file_path, n_buffers)]
+    if file_path.endswith('.zst'):
+        with open(file_path, 'rb', buffering=PICKLE_BUFFER_SIZE) as f:
+            with zstandard.ZstdDecompressor().stream_reader(f) as reader:
+                return pickle.Unpickler(reader, buffers=iter(buffers)).load()
     try:
-        with open(file_path, 'rb') as f:
-            return pickle.load(f)
+        with open(file_path, 'rb', buffering=PICKLE_BUFFER_SIZE) as f:
+            return pickle.Unpickler(f, buffers=iter(buffers)).load()
+    except FileNotFoundError:
+        raise
     except Exception:  # noqa, pylint: disable=broad-except
-        bytes_in = bytearray(0)
-        input_size = os.path.getsize(file_path)
-        with open(file_path, 'rb') as f_in:
-            for _ in range(0, input_size, MAX_PICKLE_BYTES):
-                bytes_in += f_in.read(MAX_PICKLE_BYTES)
-        return pickle.loads(bytes_in)
+        return pickle.loads(_read_file_into_buffer(file_path), buffers=iter(buffers))
 
 
 def get_age_of_file(filename, unit='days'):
-    """Return relative age of a file as a datetime.timedelta"""
-    age = (datetime.today() - datetime.fromtimestamp(getmtime(filename)))
+    """Return relative age of a file as an attribute of a datetime.timedelta ('days', 'seconds', ...)"""
+    age = timedelta(seconds=time.time() - getmtime(filename))
     return getattr(age, unit)
 
 
@@ -178,33 +538,42 @@ def get_files_in_directory(directory):
     ]
 
 
-def delete_old_disk_caches():
-    cache_metadata = load_cache_metadata_json()
-    new_cache_metadata = deepcopy(cache_metadata)
-    cache_changed = False
-    for function_name, function_caches in cache_metadata.items():
-        if function_name == _TOTAL_NUMCACHE_KEY:
-            continue
-        to_keep = []
-        for function_cache in function_caches:
-            max_age_days = int(function_cache['max_age_days'])
-            file_name = join_path(DISK_CACHE_DIR, function_cache['file_name'])
-            if not file_exists(file_name):
-                cache_changed = True
-                continue
-            if not get_age_of_file(file_name) > max_age_days != UNLIMITED_CACHE_AGE:
-                to_keep.append(function_cache)
+def delete_old_disk_caches(force=True):
+    """Remove expired cache entries and their files
+
+    Unless force is set, this is skipped if any process swept within the last
+    SWEEP_INTERVAL_SECONDS
+    """
+    with _metadata_lock():
+        cache_metadata = load_cache_metadata_json()
+        now = time.time()
+        if not force and now - cache_metadata.get(_LAST_SWEEP_KEY, 0) < SWEEP_INTERVAL_SECONDS:
+            return
+        new_cache_metadata = {_TOTAL_NUMCACHE_KEY: cache_metadata.get(_TOTAL_NUMCACHE_KEY, 0), _LAST_SWEEP_KEY: now}
+        cache_changed = False
+        for function_name, function_caches in cache_metadata.items():
+            if function_name in _RESERVED_KEYS:
                 continue
-            logger.info('Removing stale cache file %s, > %d days', file_name, max_age_days)
-            cache_changed = True
-            os.remove(file_name)
-        if to_keep:
-            new_cache_metadata[function_name] = to_keep
-    if cache_changed:
-        write_cache_file(new_cache_metadata)
+            to_keep = {}
+            for key, function_cache in function_caches.items():
+                if not _is_expired(function_cache, now):
+                    to_keep[key] = function_cache
+                    continue
+                file_name = join_path(DISK_CACHE_DIR, function_cache['file_name'])
+                logger.info('Removing stale cache file %s, > %s days', file_name, function_cache['max_age_days'])
+                cache_changed = True
+                remove_cache_file(file_name, function_cache.get('n_buffers', 0))
+            if to_keep:
+                new_cache_metadata[function_name] = to_keep
+        if cache_changed:
+            _compact(new_cache_metadata)
+        else:
+            cache_metadata[_LAST_SWEEP_KEY] = now
+            _append_journal('sweep', {'time': now})
 
 
 def get_disk_cache_for_function(function_name):
+    wait_for_writes()
     cache_metadata = load_cache_metadata_json()
     return cache_metadata.get(function_name, None)
 
@@ -217,77 +586,162 @@ def get_disk_cache_size_for_function(function_name):
 
 def delete_disk_caches_for_function(function_name):
     logger.debug('Removing cache entries for %s', function_name)
-    n_deleted = 0
-    cache_metadata = load_cache_metadata_json()
-    if function_name not in cache_metadata:
-        return
-
-    functions_to_delete_cache_for = cache_metadata.pop(function_name)
-    for function_cache in functions_to_delete_cache_for:
-        file_name = join_path(DISK_CACHE_DIR, function_cache['file_name'])
-        os.remove(file_name)
-        n_deleted += 1
+    # Don't let a queued write re-add an entry after it was cleared
+    wait_for_writes()
+    for memory_cache, memory_lock in list(_MEMORY_CACHES.get(function_name, {}).values()):
+        with memory_lock:
+            memory_cache.clear()
+    with _metadata_lock():
+        cache_metadata = load_cache_metadata_json()
+        if function_name not in cache_metadata:
+            return
+        functions_to_delete_cache_for = cache_metadata.pop(function_name)
+        _append_journal('clear', {'function_name': function_name})
+
+    # Unlinks are I/O bound and mostly wait on the filesystem, so issue them concurrently
+    file_names = [
+        join_path(DISK_CACHE_DIR, function_cache['file_name'])
+        for function_cache in functions_to_delete_cache_for.values()]
+    buffer_counts = [
+        function_cache.get('n_buffers', 0) for function_cache in functions_to_delete_cache_for.values()]
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_REMOVE_WORKERS, len(file_names)))) as executor:
+        n_deleted = len(list(executor.map(remove_cache_file, file_names, buffer_counts)))
     logger.debug('Removed %s cache entries for %s', n_deleted, function_name)
-    write_cache_file(cache_metadata)
 
 
-def cache_exists(cache_metadata, function_name, *args, **kwargs):
-    if function_name not in cache_metadata:
+def cache_exists(cache_metadata, function_name, key):
+    function_caches = cache_metadata.get(function_name)
+    if not function_caches:
         return False, None
-    new_caches_for_function = []
-    cache_changed = False
-    for function_cache in cache_metadata[function_name]:
-        if function_cache['args'] == str(args) and (
-                function_cache['kwargs'] == str(kwargs)):
-            max_age_days = int(function_cache['max_age_days'])
-            file_name = join_path(DISK_CACHE_DIR, function_cache['file_name'])
-            if file_exists(file_name):
-                if get_age_of_file(file_name) > max_age_days != UNLIMITED_CACHE_AGE:
-                    os.remove(file_name)
-                    cache_changed = True
-                else:
-                    function_value = unpickle_big_data(file_name)
-                    return True, function_value
-            else:
-                cache_changed = True
-        else:
-            new_caches_for_function.append(function_cache)
-    if cache_changed:
-        if new_caches_for_function:
-            cache_metadata[function_name] = new_caches_for_function
-        else:
-            cache_metadata.pop(function_name)
-        write_cache_file(cache_metadata)
+    function_cache = function_caches.get(key)
+    if function_cache is None:
+        return False, None
+    if zstandard is None and function_cache['file_name'].endswith('.zst'):
+        # Written by a process with zstandard installed; this one can't read it,
+        # so recompute and let the new entry replace it
+        return False, None
+    file_name = join_path(DISK_CACHE_DIR, function_cache['file_name'])
+    n_buffers = function_cache.get('n_buffers', 0)
+    if not _is_expired(function_cache, time.time()):
+        try:
+            function_value = unpickle_big_data(file_name, n_buffers)
+            return True, function_value
+        except FileNotFoundError:
+            # Deleted behind our back; drop the entry below
+            pass
+    else:
+        remove_cache_file(file_name, n_buffers)
+    with _metadata_lock():
+        function_caches.pop(key, None)
+        if not function_caches:
+            cache_metadata.pop(function_name, None)
+        _append_journal('expire', {'function_name': function_name, 'key': key})
     return False, None
 
 
+def _write_cache_entry(function_value, cache_metadata, function_name, key, new_cache, compute_time):
+    """Pickle a function value to its cache file, then record the entry in the metadata
+
+    The entry is discarded if the file is large and pickling it took long enough,
+    relative to compute_time, that loading it back likely wouldn't beat recomputing
+    """
+    file_path = join_path(DISK_CACHE_DIR, new_cache['file_name'])
+    os.makedirs(dirname(file_path), exist_ok=True)
+    pickle_start = time.perf_counter()
+    n_buffers = new_cache['n_buffers'] = pickle_big_data(function_value, file_path)
+    pickle_time = time.perf_counter() - pickle_start
+    if MIN_PAYOFF > 0 and pickle_time > MIN_PAYOFF * compute_time:
+        file_size = sum(os.path.getsize(p) for p in _buffer_file_paths(file_path, n_buffers) + [file_path])
+        if file_size > MIN_PAYOFF_BYTES:
+            logger.warning(
+                'Not caching %s(): pickling %d bytes took %.2fs, computing it took %.2fs',
+                function_name, file_size, pickle_time, compute_time)
+            remove_cache_file(file_path, n_buffers)
+            return
+    with _metadata_lock():
+        old_cache = cache_metadata.get(function_name, {}).get(key)
+        if old_cache is not None and old_cache['file_name'] == new_cache['file_name']:
+            # Rewritten in place; drop sidecars beyond the new buffer count
+            for path in _buffer_file_paths(file_path, old_cache.get('n_buffers', 0))[n_buffers:]:
+                remove_cache_file(path)
+        elif old_cache is not None:
+            # Replaced under another extension (e.g. .pkl.zst by .pkl); drop the old file
+            remove_cache_file(join_path(DISK_CACHE_DIR, old_cache['file_name']), old_cache.get('n_buffers', 0))
+        cache_metadata.setdefault(function_name, {})[key] = new_cache
+        _append_journal('add', {'function_name': function_name, 'key': key, 'entry': new_cache})
+
+
+def _drain_writes(write_queue):
+    """Background writer thread; performs queued _write_cache_entry() calls in order"""
+    while True:
+        job = write_queue.get()
+        try:
+            _write_cache_entry(*job)
+        except Exception:  # noqa, pylint: disable=broad-except
+            logger.exception('Failed to write cache entry for %s()', job[2])
+        finally:
+            write_queue.task_done()
+
+
+def _submit_write(*job):
+    """Queue a _write_cache_entry() call for the background writer, starting it if needed"""
+    with _WRITER_LOCK:
+        if _WRITER_STATE['thread'] is None:
+            _WRITER_STATE['queue'] = queue.Queue(maxsize=MAX_PENDING_WRITES)
+            _WRITER_STATE['thread'] = threading.Thread(
+                target=_drain_writes, args=(_WRITER_STATE['queue'],),
+                name='cache_to_disk-writer', daemon=True)
+            _WRITER_STATE['thread'].start()
+        write_queue = _WRITER_STATE['queue']
+    write_queue.put(job)
+
+
+def _reset_writer():
+    """Forget the parent's writer in a forked child; its thread doesn't exist there"""
+    _WRITER_STATE['queue'] = _WRITER_STATE['thread'] = None
+
+
+def wait_for_writes():
+    """Block until every queued background cache write has been written to disk"""
+    write_queue = _WRITER_STATE['queue']
+    if write_queue is not None:
+        write_queue.join()
+
+
 def cache_function_value(
         function_value,
         n_days_to_cache,
         cache_metadata,
         function_name,
+        key,
+        compute_time,
         *args,
         **kwargs):
-    if function_name == _TOTAL_NUMCACHE_KEY:
+    if function_name in _RESERVED_KEYS:
         raise Exception(
-            'Cant cache function named %s' % _TOTAL_NUMCACHE_KEY)
-    function_caches = cache_metadata.get(function_name, [])
-    new_file_name = str(int(cache_metadata[_TOTAL_NUMCACHE_KEY]) + 1) + '.pkl'
+            'Cant cache function named %s' % function_name)
     new_cache = {
         'args': str(args),
         'kwargs': str(kwargs),
-        'file_name': new_file_name,
-        'max_age_days': n_days_to_cache
+        'file_name': _cache_file_name(function_name, key),
+        'max_age_days': n_days_to_cache,
+        'expires_at': _expires_at(n_days_to_cache, time.time())
     }
-    pickle_big_data(function_value, join_path(DISK_CACHE_DIR, new_file_name))
-    function_caches.append(new_cache)
-    cache_metadata[function_name] = function_caches
-    cache_metadata[_TOTAL_NUMCACHE_KEY] = int(cache_metadata[_TOTAL_NUMCACHE_KEY]) + 1
-    write_cache_file(cache_metadata)
+    job = (function_value, cache_metadata, function_name, key, new_cache, compute_time)
+    if BACKGROUND_WRITES:
+        _submit_write(*job)
+    else:
+        _write_cache_entry(*job)
+
 
+def cache_to_disk(n_days_to_cache=DEFAULT_CACHE_AGE, memory_cache_size=DEFAULT_MEMORY_CACHE_SIZE):
+    """Cache to disk
 
-def cache_to_disk(n_days_to_cache=DEFAULT_CACHE_AGE):
-    """Cache to disk"""
+    If memory_cache_size is positive, that many of the most recent results are also
+    kept in memory, so repeated calls within a process skip reading and unpickling
+    the cache file. Like functools.lru_cache, those calls return the same object
+    each time
+    """
     if n_days_to_cache == UNLIMITED_CACHE_AGE:
         warnings.warn('Using an unlimited age cache is not recommended', stacklevel=3)
     if isinstance(n_days_to_cache, int):
@@ -297,49 +751,90 @@ def cache_to_disk(n_days_to_cache=DEFAULT_CACHE_AGE):
         raise TypeError('Expected n_days_to_cache to be an integer or None')
 
     def decorating_function(original_function):
-        wrapper = _cache_to_disk_wrapper(original_function, n_days_to_cache, _CacheInfo)
+        wrapper = _cache_to_disk_wrapper(original_function, n_days_to_cache, memory_cache_size, _CacheInfo)
         return wrapper
 
     return decorating_function
 
 
-def _cache_to_disk_wrapper(original_func, n_days_to_cache, _CacheInfo):  # noqa, pylint: disable=invalid-name
+def _cache_to_disk_wrapper(
+        original_func, n_days_to_cache, memory_cache_size, _CacheInfo):  # noqa, pylint: disable=invalid-name
     hits = misses = nocache = 0
+    # key -> (function_value, expires_at), least recently used first
+    memory_cache = OrderedDict()
+    # OrderedDict reordering isn't thread-safe; guards every access to memory_cache
+    memory_lock = threading.Lock()
+    # Bind everything the per-call path needs once, rather than looking it up on every call
+    function_name = original_func.__name__
+    make_key, load_metadata, exists, store = _make_key, load_cache_metadata_json, cache_exists, cache_function_value
+    now, perf_counter, expires_at_for, debug = time.time, time.perf_counter, _expires_at, logger.debug
+
+    def remember(key, function_value, expires_at):
+        if memory_cache_size <= 0:
+            return
+        with memory_lock:
+            memory_cache[key] = (function_value, expires_at)
+            if len(memory_cache) > memory_cache_size:
+                memory_cache.popitem(last=False)
 
     def wrapper(*args, **kwargs):
         nonlocal hits, misses, nocache
-        cache_metadata = load_cache_metadata_json()
-        already_cached, function_value = cache_exists(
-            cache_metadata, original_func.__name__, *args, **kwargs)
+        if not _SWEEP_STATE['checked']:
+            _SWEEP_STATE['checked'] = True
+            delete_old_disk_caches(force=False)
+        key = make_key(args, kwargs)
+        with memory_lock:
+            cached = memory_cache.get(key)
+            if cached is not None and (not cached[1] or now() <= cached[1]):
+                memory_cache.move_to_end(key)
+            elif cached is not None:
+                del memory_cache[key]
+                cached = None
+        if cached is not None:
+            debug('Memory cache HIT on %s (hits=%s, misses=%s, nocache=%s)',
+                  function_name, hits, misses, nocache)
+            hits += 1
+            return cached[0]
+
+        cache_metadata = load_metadata()
+        already_cached, function_value = exists(cache_metadata, function_name, key)
         if already_cached:
-            logger.debug('Cache HIT on %s (hits=%s, misses=%s, nocache=%s)',
-                         original_func.__name__, hits, misses, nocache)
+            debug('Cache HIT on %s (hits=%s, misses=%s, nocache=%s)',
+                  function_name, hits, misses, nocache)
             hits += 1
+            function_cache = cache_metadata.get(function_name, {}).get(key)
+            if function_cache is not None:
+                remember(key, function_value, function_cache['expires_at'])
             return function_value
 
-        logger.debug('Cache MISS on %s (hits=%s, misses=%s, nocache=%s)',
-                     original_func.__name__, hits, misses, nocache)
-        logger.debug(' -- MISS ARGS:    (%s)', ','.join(
-            [str(arg) for arg in args]))
-        logger.debug(' -- MISS KWARGS:  (%s)', ','.join(
-            ['{}={}'.format(str(k), str(v)) for k, v in kwargs.items()]))
+        debug('Cache MISS on %s (hits=%s, misses=%s, nocache=%s)',
+              function_name, hits, misses, nocache)
+        if logger.isEnabledFor(logging.DEBUG):
+            debug(' -- MISS ARGS:    (%s)', ','.join(
+                [str(arg) for arg in args]))
+            debug(' -- MISS KWARGS:  (%s)', ','.join(
+                ['{}={}'.format(str(k), str(v)) for k, v in kwargs.items()]))
         misses += 1
 
+        compute_start = perf_counter()
         try:
             function_value = original_func(*args, **kwargs)
         except NoCacheCondition as err:
             nocache += 1
-            logger.debug('%s() threw NoCacheCondition exception; no new cache entry', original_func.__name__)
+            debug('%s() threw NoCacheCondition exception; no new cache entry', function_name)
             function_value = err.function_value
         else:
-            logger.debug('%s() returned, adding cache entry', original_func.__name__)
-            cache_function_value(
+            debug('%s() returned, adding cache entry', function_name)
+            store(
                 function_value,
                 n_days_to_cache,
                 cache_metadata,
-                original_func.__name__,
+                function_name,
+                key,
+                perf_counter() - compute_start,
                 *args,
                 **kwargs)
+            remember(key, function_value, expires_at_for(n_days_to_cache, now()))
         return function_value
 
     def cache_info():
@@ -347,25 +842,30 @@ def _cache_to_disk_wrapper(original_func, n_days_to_cache, _CacheInfo):  # noqa,
         return _CacheInfo(hits, misses, nocache)
 
     def cache_clear():
-        """Clear the cache permanently from disk for this function"""
-        logger.info('Cache clear requested for %s(); %s items in cache ...', original_func.__name__, )
-        delete_disk_caches_for_function(original_func.__name__)
+        """Clear the cache permanently from disk and memory for this function"""
+        logger.info('Cache clear requested for %s(); %s items in cache ...', function_name, )
+        delete_disk_caches_for_function(function_name)
 
     def cache_size():
         """Return the number of cached entries for this function"""
-        return get_disk_cache_size_for_function(original_func.__name__)
+        return get_disk_cache_size_for_function(function_name)
 
     def cache_get_raw():
-        """Return the raw cache object for this function as a list of dicts"""
+        """Return the raw cache object for this function as a dict of dicts, keyed by argument hash"""
         warnings.warn('This is an internal interface and should not be used lightly', stacklevel=3)
-        return get_disk_cache_for_function(original_func.__name__)
+        return get_disk_cache_for_function(function_name)
 
     wrapper.cache_info = cache_info
     wrapper.cache_clear = cache_clear
     wrapper.cache_size = cache_size
     wrapper.cache_get_raw = cache_get_raw
+    _MEMORY_CACHES.setdefault(function_name, weakref.WeakKeyDictionary())[wrapper] = (memory_cache, memory_lock)
     return wrapper
 
 
 ensure_dir(DISK_CACHE_DIR)
-delete_old_disk_caches()
+# atexit runs handlers last-in first-out: finish pending writes, then compact
+atexit.register(_compact_if_dirty)
+atexit.register(wait_for_writes)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_writer)
@@ -13,6 +13,10 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/sarenehan/cache_to_disk",
     packages=setuptools.find_packages(),
+    extras_require={
+        "orjson": ["orjson"],
+        "zstd": ["zstandard"],
+    },
     classifiers=(
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",